@@ -1,58 +1,91 @@
 # bot.py — с коллекциями, поиском, уведомлениями и исправленными ошибками (и сортировкой!)
 
 import os
+import sys
 import json
+import logging
+import logging.handlers
+import queue
+import time
 import asyncio
 import re
-import math
+import functools
+import inspect
+import itertools
+from array import array
+from operator import itemgetter
 import random 
-from pathlib import Path
-from typing import Optional, List, Any
+import zlib
+from typing import Optional, Any, Callable, NamedTuple
+import aiohttp
+from aiolimiter import AsyncLimiter
 from pytz import timezone
 from aiogram.filters.callback_data import CallbackData
-from asyncio import to_thread # Импорт для асинхронного запуска синхронных функций
 
 # --- Aiogram и другие библиотеки ---
-from aiogram import Bot, Dispatcher, types, F, html
+from aiogram import Bot, Dispatcher, types, html
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
 
-# --- Доп. импорты для устойчивости ---
-AIOFILES_AVAILABLE = False
+# --- Быстрый JSON (orjson), с откатом на стандартный json ---
+ORJSON_AVAILABLE = False
 try:
-    import aiofiles
-    AIOFILES_AVAILABLE = True
+    import orjson
+    ORJSON_AVAILABLE = True
 except Exception:
-    AIOFILES_AVAILABLE = False
-
-# --- Telegraph ---
-TELEGRAPH_AVAILABLE = True
-Telegraph = None
-tg_exceptions = None
-try:
-    # Используем СИНХРОННЫЙ клиент, который у вас установлен
-    from telegraph import Telegraph, exceptions as tg_exceptions 
-except Exception:
-    TELEGRAPH_AVAILABLE = False
+    ORJSON_AVAILABLE = False
 
 # --- Константы ---
 COMICS_AUTHOR_NAME = "EasyReaderBot"
 DATA_JSON = "data.json"
 LINKS_JSON = "links.json"
 USERS_FILE = "users.json"
+# Ссылки на уже созданные страницы Telegra.ph, сохраняются между перезапусками
+TELEGRAPH_URLS_FILE = "telegraph_urls.json"
 TZ_INFO = timezone("Asia/Almaty")
 # Максимальное количество кнопок в ряду для глав
 CHAPTERS_PER_ROW = 5 
 
+# --- Логирование ---
+log = logging.getLogger("comic_reader_bot")
+log.setLevel(logging.INFO)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Подключает к корневому логгеру QueueHandler и запускает QueueListener, пишущий в stderr
+    (форматирование остаётся в вызывающем потоке, в фон вынесена только запись).
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
 # --- Загрузка .env ---
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 TELEGRAPH_ENABLED = os.getenv("TELEGRAPH_ENABLED", "1") != "0" 
+TELEGRAPH_API_URL = "https://api.telegra.ph"
+# Если включено, страницы Telegra.ph для всех глав создаются в фоне после запуска
+TELEGRAPH_PREPOPULATE = os.getenv("TELEGRAPH_PREPOPULATE", "0") == "1"
+# Если задан WEBHOOK_URL, бот принимает обновления через вебхук вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
 
 if not BOT_TOKEN:
     raise RuntimeError("❌ BOT_TOKEN не найден в .env. Добавьте его для запуска.")
@@ -74,80 +107,255 @@ class CollectionCallback(CallbackData, prefix="coll"):
     collection_key: str 
     action: str 
 
-class ComicCallback(CallbackData, prefix="comic"):
+class ComicCallback(CallbackData, prefix="c"):
     collection_key: str
-    comic_key: str
+    comic_id: str
     action: str 
     page: int = 1
 
 
+# Формат кнопок до перехода на короткие идентификаторы: такие кнопки остались в уже отправленных сообщениях
+class LegacyComicCallback(CallbackData, prefix="comic"):
+    collection_key: str
+    comic_key: str
+    action: str
+    page: int = 1
+
+
+_BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+@functools.lru_cache(maxsize=8192)
+def comic_short_id(comic_key: str) -> str:
+    """
+    Короткий идентификатор комикса для callback_data (не длиннее 7 символов):
+    crc32 ключа в base36. В отличие от порядкового номера он не меняется при
+    правке каталога, поэтому кнопки в старых сообщениях продолжают работать.
+    Итоговый идентификатор (с учётом коллизий) выдаёт get_comic_ids().
+    """
+    value = zlib.crc32(comic_key.encode("utf-8"))
+    digits = []
+    while True:
+        value, rem = divmod(value, 36)
+        digits.append(_BASE36[rem])
+        if not value:
+            return "".join(reversed(digits))
+
+
+@functools.lru_cache(maxsize=8192)
+def _pack_comic(collection_key: str, comic_id: str, action: str, page: int = 1) -> str:
+    """Кэширует ComicCallback(...).pack(): одни и те же кнопки упаковываются при каждом листании."""
+    return ComicCallback(collection_key=collection_key, comic_id=comic_id, action=action, page=page).pack()
+
+
+# Упакованные callback_data кнопок меню: pack() не зависит от пользователя, считаем один раз
+_PACKED = {
+    action: MenuCallback(action=action).pack()
+    for action in ("search", "random", "collections", "donate", "toggle_notify", "back")
+}
+
+
+# --- Маршрутизация callback-запросов ---
+# prefix -> (класс CallbackData, {action: (хэндлер, нужен ли callback_data, нужен ли state)})
+_CALLBACK_ROUTES: dict[str, tuple[type[CallbackData], dict[str, tuple[Callable, bool, bool]]]] = {}
+
+
+def callback_route(callback_cls: type[CallbackData], action: str) -> Callable:
+    """
+    Регистрирует хэндлер для пары (префикс, action). Вместо цепочки фильтров, каждый
+    из которых заново распаковывает callback_data, запрос распаковывается один раз
+    и находит хэндлер поиском в словаре.
+    """
+    def decorator(handler: Callable) -> Callable:
+        params = inspect.signature(handler).parameters
+        _, actions = _CALLBACK_ROUTES.setdefault(callback_cls.__prefix__, (callback_cls, {}))
+        actions[action] = (handler, "callback_data" in params, "state" in params)
+        return handler
+    return decorator
+
+
+# --- Telegra.ph (асинхронный клиент поверх aiohttp) ---
+class TelegraphError(Exception):
+    """Ошибка, которую вернул API Telegra.ph (ответ с ok=false)."""
+
+
+class TelegraphClient:
+    """
+    Минимальный клиент Telegra.ph API. Все запросы идут через одну общую aiohttp-сессию,
+    поэтому соединение и TLS переиспользуются, а потоки не занимаются.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self._session = session
+        self.access_token: Optional[str] = None
+
+    async def _call(self, method: str, **params: str) -> dict:
+        async with self._session.post(f"{TELEGRAPH_API_URL}/{method}", data=params) as response:
+            payload = await response.json(content_type=None)
+        if not payload.get("ok"):
+            raise TelegraphError(payload.get("error", "Unknown error"))
+        return payload["result"]
+
+    async def create_account(self, short_name: str) -> dict:
+        account = await self._call("createAccount", short_name=short_name)
+        self.access_token = account["access_token"]
+        return account
+
+    async def create_page(self, title: str, author_name: str, content: str) -> dict:
+        """content — JSON-массив узлов Telegra.ph (Node), уже сериализованный в строку."""
+        return await self._call(
+            "createPage",
+            access_token=self.access_token,
+            title=title,
+            author_name=author_name,
+            content=content,
+        )
+
+
 # --- Вспомогательные функции ---
 
 
+# Разбиение на группы цифр/не-цифр для естественной сортировки
+_NAT_SPLIT = re.compile(r"(\d+)")
+# Номер главы в названии вида "Глава N"
+_CHAPTER_NUM_RE = re.compile(r"\d+")
+
+
+@functools.lru_cache(maxsize=4096)
 def natural_sort_key(s: str):
     """
     Возвращает ключ для естественной сортировки, извлекая числа.
     Например, 'chapter_10' будет идти после 'chapter_2', а не до.
+    Результат — кортеж, поэтому его можно кэшировать.
     """
     if not isinstance(s, str):
         return s
-    return [int(text) if text.isdigit() else text.lower() for text in re.split(r"(\d+)", s)]
+    # split с захватывающей группой чередует части: чётные — текст, нечётные — числа
+    parts = _NAT_SPLIT.split(s.lower())
+    return tuple(int(part) if i & 1 else part for i, part in enumerate(parts))
+
+
+def _json_loads(content: bytes) -> Any:
+    """Разбирает JSON из байтов: orjson, если доступен, иначе стандартный json."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _json_dumps(data: Any) -> bytes:
+    """Сериализует данные в UTF-8 JSON с отступом в 2 пробела."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def _read_file(path: str) -> tuple[int, Any]:
+    """Открывает, читает и разбирает JSON файл за один переход в поток. Возвращает (st_mtime_ns, данные)."""
+    with open(path, "rb") as f:
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        return mtime_ns, _json_loads(f.read())
+
+
+def _write_file(path: str, data: Any) -> int:
+    """
+    Сериализует и атомарно записывает JSON файл за один переход в поток:
+    пишем во временный файл рядом и заменяем им исходный через os.replace,
+    так что падение посреди записи не оставит повреждённый JSON.
+    Возвращает st_mtime_ns записанного файла.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_json_dumps(data))
+        f.flush()
+        os.fsync(f.fileno())
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+    os.replace(tmp_path, path)
+    return mtime_ns
+
+
+# Кэш разобранных JSON файлов: путь -> (st_mtime_ns, данные, производные индексы)
+_JSON_CACHE: dict[str, tuple[int, Any, dict[str, Any]]] = {}
+# Блокировки чтения по файлам: одновременные промахи кэша разбирают файл один раз
+_JSON_LOCKS: dict[str, asyncio.Lock] = {}
+
+
+def invalidate_json_cache(path: str) -> None:
+    """Сбрасывает кэш для файла, чтобы следующее чтение взяло свежие данные с диска."""
+    _JSON_CACHE.pop(path, None)
 
 
 async def load_json_async(path: str) -> Optional[Any]:
-    """Асинхронно загружает JSON файл. Работает и без aiofiles."""
-    if AIOFILES_AVAILABLE:
+    """
+    Асинхронно загружает JSON файл с кэшированием по mtime.
+    Возвращает общий закэшированный объект — изменять его нельзя.
+    """
+    entry = await _load_cache_entry(path)
+    return entry[1] if entry is not None else None
+
+
+async def get_cached_index(path: str, name: str, build: Callable[[Any], Any]) -> Any:
+    """
+    Возвращает производный от JSON файла индекс. build(data) вызывается один раз
+    на каждую версию файла; при смене mtime индекс строится заново.
+    """
+    entry = await _load_cache_entry(path)
+    if entry is None:
+        return build(None)
+    derived = entry[2]
+    if name not in derived:
+        derived[name] = build(entry[1])
+    return derived[name]
+
+
+async def _load_cache_entry(path: str) -> Optional[tuple[int, Any, dict[str, Any]]]:
+    """Возвращает запись кэша для файла, перечитывая его только при смене mtime."""
+    try:
+        st = await asyncio.to_thread(os.stat, path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.error("❌ Ошибка при чтении %s: %s", path, e)
+        return None
+
+    cached = _JSON_CACHE.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns:
+        return cached
+
+    async with _JSON_LOCKS.setdefault(path, asyncio.Lock()):
+        # Пока ждали блокировку, файл мог уже прочитать другой запрос
+        cached = _JSON_CACHE.get(path)
+        if cached is not None and cached[0] == st.st_mtime_ns:
+            return cached
+
         try:
-            async with aiofiles.open(path, mode="r", encoding="utf-8") as f:
-                content = await f.read()
-                return json.loads(content)
+            mtime_ns, data = await asyncio.to_thread(_read_file, path)
         except FileNotFoundError:
             return None
         except json.JSONDecodeError as e:
-            print(f"❌ Ошибка при чтении {path}. Файл поврежден: {e}")
+            log.error("❌ Ошибка при чтении %s. Файл поврежден: %s", path, e)
             return None
         except Exception as e:
-            print(f"❌ Ошибка при чтении {path}: {e}")
+            log.error("❌ Ошибка при чтении %s: %s", path, e)
             return None
-    else:
-        # fallback — читаем в отдельном потоке
-        def _read_file():
-            if not Path(path).exists():
-                return None
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
 
-        try:
-            return await asyncio.to_thread(_read_file)
-        except json.JSONDecodeError as e:
-            print(f"❌ Ошибка при чтении {path}. Файл поврежден: {e}")
-            return None
-        except Exception as e:
-            print(f"❌ Ошибка при чтении {path}: {e}")
-            return None
+        entry = (mtime_ns, data, {})
+        _JSON_CACHE[path] = entry
+        return entry
 
 
 async def save_json_async(path: str, data: dict | list) -> bool:
-    """Асинхронно сохраняет JSON файл. Работает и без aiofiles."""
-    if AIOFILES_AVAILABLE:
-        try:
-            async with aiofiles.open(path, mode="w", encoding="utf-8") as f:
-                await f.write(json.dumps(data, ensure_ascii=False, indent=2))
-            return True
-        except Exception as e:
-            print(f"❌ Ошибка при записи в {path}: {e}")
-            return False
-    else:
-        def _write_file():
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-
-        try:
-            await asyncio.to_thread(_write_file)
-            return True
-        except Exception as e:
-            print(f"❌ Ошибка при записи в {path}: {e}")
-            return False
+    """
+    Асинхронно сохраняет JSON файл в отдельном потоке и сразу кладёт data в кэш.
+    После сохранения data становится общим закэшированным объектом — не изменяйте его.
+    """
+    try:
+        mtime_ns = await asyncio.to_thread(_write_file, path, data)
+    except Exception as e:
+        log.error("❌ Ошибка при записи в %s: %s", path, e)
+        invalidate_json_cache(path)
+        return False
+    _JSON_CACHE[path] = (mtime_ns, data, {})
+    return True
 
 
 # Загружает данные только при необходимости
@@ -167,65 +375,434 @@ async def get_chapters_data(collection_key: str, comic_key: str) -> dict:
     return comics.get(comic_key, {}).get("chapters", {})
 
 
-# Получает список ссылок на изображения для главы
-async def get_links_list(collection_key: str, comic_key: str, chapter_key: str) -> list:
-    links_data = await load_json_async(LINKS_JSON) or {}
-    return links_data.get(collection_key, {}).get(comic_key, {}).get(chapter_key, [])
+def _build_sorted_chapter_keys(all_data: Optional[dict]) -> dict[tuple[str, str], tuple[str, ...]]:
+    """Сортирует главы каждого комикса в естественном порядке: (collection_key, comic_key) -> ключи глав."""
+    sorted_keys = {}
+    for collection_key, collection_data in (all_data or {}).items():
+        for comic_key, comic_data in collection_data.get("comics", {}).items():
+            chapters = comic_data.get("chapters", {})
+            sorted_keys[(collection_key, comic_key)] = tuple(sorted(chapters.keys(), key=natural_sort_key))
+    return sorted_keys
+
+
+# Получает отсортированные ключи глав (одна сортировка на версию data.json)
+async def get_sorted_chapter_keys(collection_key: str, comic_key: str) -> tuple[str, ...]:
+    sorted_keys = await get_cached_index(DATA_JSON, "sorted_chapter_keys", _build_sorted_chapter_keys)
+    return sorted_keys.get((collection_key, comic_key), ())
+
+
+def _build_sorted_comic_keys(all_data: Optional[dict]) -> dict[str, tuple[str, ...]]:
+    """Сортирует комиксы каждой коллекции по названию: collection_key -> ключи комиксов."""
+    sorted_keys = {}
+    for collection_key, collection_data in (all_data or {}).items():
+        comics = collection_data.get("comics", {})
+        sorted_keys[collection_key] = tuple(sorted(comics.keys(), key=lambda k: comics[k].get("title", k)))
+    return sorted_keys
+
+
+# Получает ключи комиксов коллекции, отсортированные по названию (одна сортировка на версию data.json)
+async def get_sorted_comic_keys(collection_key: str) -> tuple[str, ...]:
+    sorted_keys = await get_cached_index(DATA_JSON, "sorted_comic_keys", _build_sorted_comic_keys)
+    return sorted_keys.get(collection_key, ())
+
+
+def _build_chapter_titles(all_data: Optional[dict]) -> dict[tuple[str, str, str], tuple[str, str]]:
+    """Плоская таблица заголовков: (collection_key, comic_key, chapter_key) -> (comic_title, chapter_title)."""
+    titles = {}
+    for collection_key, collection_data in (all_data or {}).items():
+        for comic_key, comic_data in collection_data.get("comics", {}).items():
+            comic_title = comic_data.get("title", "Комикс")
+            for chapter_key, chapter_title in comic_data.get("chapters", {}).items():
+                titles[(collection_key, comic_key, chapter_key)] = (comic_title, chapter_title)
+    return titles
+
+
+# Получает таблицу заголовков глав (строится один раз на версию data.json)
+async def get_chapter_titles() -> dict[tuple[str, str, str], tuple[str, str]]:
+    return await get_cached_index(DATA_JSON, "chapter_titles", _build_chapter_titles)
+
+
+class ComicIds(NamedTuple):
+    by_key: dict[tuple[str, str], str]  # (collection_key, comic_key) -> comic_id
+    by_id: dict[tuple[str, str], str]  # (collection_key, comic_id) -> comic_key
+
+    def id_of(self, collection_key: str, comic_key: str) -> str:
+        # Комикс мог пропасть из data.json между чтениями — тогда берём хэш без суффикса
+        return self.by_key.get((collection_key, comic_key)) or comic_short_id(comic_key)
+
+
+def _build_comic_ids(all_data: Optional[dict]) -> ComicIds:
+    """
+    Таблицы коротких идентификаторов комиксов в обе стороны. Ключи обходятся
+    в отсортированном порядке, и при совпадении хэшей следующий комикс получает
+    идентификатор с суффиксом "-N" — у каждого комикса коллекции он свой.
+    """
+    by_key, by_id = {}, {}
+    for collection_key, collection_data in (all_data or {}).items():
+        for comic_key in sorted(collection_data.get("comics", {})):
+            base_id = comic_id = comic_short_id(comic_key)
+            suffix = 0
+            while (collection_key, comic_id) in by_id:
+                suffix += 1
+                comic_id = f"{base_id}-{suffix}"
+            if suffix:
+                log.warning("⚠️ Коллизия идентификаторов комиксов %r и %r в коллекции %r, выдан %s",
+                            by_id[(collection_key, base_id)], comic_key, collection_key, comic_id)
+            by_key[(collection_key, comic_key)] = comic_id
+            by_id[(collection_key, comic_id)] = comic_key
+    return ComicIds(by_key, by_id)
+
+
+# Получает таблицы идентификаторов комиксов (строятся один раз на версию data.json)
+async def get_comic_ids() -> ComicIds:
+    return await get_cached_index(DATA_JSON, "comic_ids", _build_comic_ids)
+
+
+# Находит ключ комикса по идентификатору из callback_data (None, если комикс удалён)
+async def resolve_comic_key(collection_key: str, comic_id: str) -> Optional[str]:
+    return (await get_comic_ids()).by_id.get((collection_key, comic_id))
+
+
+class ComicInfo(NamedTuple):
+    title: str
+    chapters: dict
+
+
+class ChapterInfo(NamedTuple):
+    comic_title: str
+    chapter_key: str
+    chapter_title: str
+    links: list
+
+
+# Получает заголовок и главы комикса за одно обращение к data.json
+async def resolve_comic(collection_key: str, comic_key: str) -> ComicInfo:
+    data = await get_all_data()
+    comic_data = data.get(collection_key, {}).get("comics", {}).get(comic_key, {})
+    return ComicInfo(comic_data.get("title", "Комикс"), comic_data.get("chapters", {}))
+
+
+async def resolve_chapter(collection_key: str, comic_key: str, chapter_number: int) -> Optional[ChapterInfo]:
+    """
+    Находит главу по её порядковому номеру (с 1) в отсортированном списке глав.
+    data.json и links.json читаются по одному разу. Возвращает None, если номер вне диапазона.
+    """
+    # data.json и links.json читаются параллельно: при холодном кэше чтения перекрываются
+    chapter_keys, titles, links_data = await asyncio.gather(
+        get_sorted_chapter_keys(collection_key, comic_key),
+        get_chapter_titles(),
+        load_json_async(LINKS_JSON),
+    )
+
+    chapter_index = chapter_number - 1
+    if chapter_index < 0 or chapter_index >= len(chapter_keys):
+        return None
+
+    chapter_key = chapter_keys[chapter_index]
+    comic_title, chapter_title = titles.get((collection_key, comic_key, chapter_key), ("Комикс", f"Глава {chapter_number}"))
+    links_list = (links_data or {}).get(collection_key, {}).get(comic_key, {}).get(chapter_key, [])
+    return ChapterInfo(comic_title, chapter_key, chapter_title, links_list)
 
 
 # <--- НОВАЯ ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ ДЛЯ РАНДОМАЙЗЕРА --->
-async def get_all_comic_identifiers() -> List[tuple[str, str, str]]:
-    """Собирает список всех комиксов в формате (collection_key, comic_key, comic_title)
-    для обеспечения равномерного случайного выбора."""
-    all_data = await get_all_data()
+def _build_comic_identifiers(all_data: Optional[dict]) -> tuple[tuple[str, str, str], ...]:
+    """Собирает плоский список всех комиксов в формате (collection_key, comic_key, comic_title)."""
     all_comics = []
 
-    for collection_key, collection_data in all_data.items():
+    for collection_key, collection_data in (all_data or {}).items():
         comics_in_collection = collection_data.get("comics", {})
         for comic_key, comic_data in comics_in_collection.items():
             title = comic_data.get("title", comic_key)
             all_comics.append((collection_key, comic_key, title))
-            
-    return all_comics
+
+    return tuple(all_comics)
+
+
+async def get_all_comic_identifiers() -> tuple[tuple[str, str, str], ...]:
+    """Список всех комиксов для равномерного случайного выбора.
+    Строится один раз на версию data.json и хранится рядом с кэшем файла."""
+    return await get_cached_index(DATA_JSON, "comic_identifiers", _build_comic_identifiers)
 # <--- КОНЕЦ НОВОЙ ВСПОМОГАТЕЛЬНОЙ ФУНКЦИИ --->
 
 
-# Создание HTML-контента для Telegra.ph
-def create_html_content(links_list: List[str]) -> str:
-    """Создает простой HTML-контент из списка ссылок на изображения для Telegra.ph."""
-    content = ""
-    for url in links_list:
-        # Добавление <br> для минимального разделения изображений
-        content += f'<img src="{url}"><br>' 
+class SearchIndex(NamedTuple):
+    # (title_lower, collection_key, comic_key, title) — названия приведены к нижнему регистру заранее,
+    # записи отсортированы по title_lower
+    entries: tuple[tuple[str, str, str, str], ...]
+    # биграмма / триграмма -> возрастающие номера записей в entries, чьё название её содержит
+    bigrams: dict[str, array]
+    trigrams: dict[str, array]
+
+
+def _ngrams(text: str, n: int) -> set[str]:
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _build_postings(entries: tuple[tuple[str, str, str, str], ...], n: int) -> dict[str, array]:
+    """Инвертированный индекс n-грамм: номера записей добавляются по возрастанию, без повторов."""
+    postings: dict[str, array] = {}
+    for i, entry in enumerate(entries):
+        for gram in _ngrams(entry[0], n):
+            postings.setdefault(gram, array("i")).append(i)
+    return postings
+
+
+def _build_search_index(all_data: Optional[dict]) -> SearchIndex:
+    """
+    Строит плоский индекс названий и инвертированные индексы биграмм и триграмм по нему.
+    Записи отсортированы по названию, поэтому результаты поиска сразу идут в нужном порядке.
+    """
+    entries = tuple(sorted(
+        ((title.lower(), collection_key, comic_key, title)
+         for collection_key, comic_key, title in _build_comic_identifiers(all_data)),
+        key=itemgetter(0),
+    ))
+    return SearchIndex(entries, _build_postings(entries, 2), _build_postings(entries, 3))
+
+
+def _filter_search_index(index: SearchIndex, query: str) -> list[tuple[str, str, str, str]]:
+    """
+    Отбирает записи, чьё название содержит query (уже в нижнем регистре).
+    Кандидаты — пересечение списков по триграммам запроса (по биграмме для двух символов),
+    затем точная проверка подстроки. Для односимвольных запросов — линейный проход.
+    """
+    if len(query) < 2:
+        return [entry for entry in index.entries if query in entry[0]]
+
+    n, ngram_postings = (2, index.bigrams) if len(query) == 2 else (3, index.trigrams)
+    postings = [ngram_postings.get(gram) for gram in _ngrams(query, n)]
+    if not all(postings):
+        return []
+    postings.sort(key=len)
+    candidates = set(postings[0])
+    for posting in postings[1:]:
+        candidates.intersection_update(posting)
+    return [index.entries[i] for i in sorted(candidates) if query in index.entries[i][0]]
+
+
+async def search_comics(query: str) -> list[tuple[str, str, str, str]]:
+    """
+    Ищет комиксы по части названия (query — в нижнем регистре).
+    Перебор идёт в отдельном потоке, чтобы большой каталог не блокировал цикл событий.
+    """
+    index = await get_cached_index(DATA_JSON, "search_index", _build_search_index)
+    return await asyncio.to_thread(_filter_search_index, index, query)
+
+
+async def warm_up_caches() -> None:
+    """Заранее читает каталог и строит индексы, чтобы первые пользователи не ждали их построения."""
+    await get_cached_index(DATA_JSON, "search_index", _build_search_index)
+    await get_cached_index(DATA_JSON, "comic_identifiers", _build_comic_identifiers)
+    await get_cached_index(DATA_JSON, "sorted_comic_keys", _build_sorted_comic_keys)
+    await get_cached_index(DATA_JSON, "sorted_chapter_keys", _build_sorted_chapter_keys)
+    await get_comic_ids()
+    await get_chapter_titles()
+    await get_subscribed_users()
+    await get_telegraph_urls()
+
+
+# Создание контента страницы Telegra.ph
+def create_page_content(links_list: list[str]) -> str:
+    """
+    Собирает JSON-массив узлов Telegra.ph (по одному <img> на ссылку): список узлов
+    строится одним генератором списка и сериализуется за один проход, без HTML.
+    """
+    nodes = [{"tag": "img", "attrs": {"src": url}} for url in links_list]
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(nodes).decode("utf-8")
+    return json.dumps(nodes, ensure_ascii=False)
+
+
+def _new_chapter_cache(_links_data: Any) -> dict:
+    """Пустой кэш по главам, привязанный к версии links.json: при её смене сбрасывается."""
+    return {}
+
+
+def _links_digest(links_list: list[str]) -> str:
+    """Отпечаток списка ссылок главы: сохранённая страница годится, пока ссылки не менялись."""
+    return format(zlib.crc32("\n".join(links_list).encode("utf-8")), "08x")
+
+
+def _build_telegraph_urls(saved: Optional[dict], links_data: Optional[dict]) -> dict[tuple[str, str, str], str]:
+    """Берёт из telegraph_urls.json страницы, чьи ссылки совпадают с текущим links.json."""
+    urls = {}
+    links_data = links_data or {}
+    for collection_key, comics in (saved or {}).items():
+        for comic_key, chapters in comics.items():
+            comic_links = links_data.get(collection_key, {}).get(comic_key, {})
+            for chapter_key, (url, digest) in chapters.items():
+                links_list = comic_links.get(chapter_key)
+                if links_list and _links_digest(links_list) == digest:
+                    urls[(collection_key, comic_key, chapter_key)] = url
+    return urls
+
+
+# Получает URL уже созданных страниц Telegra.ph: (collection_key, comic_key, chapter_key) -> url
+async def get_telegraph_urls() -> dict[tuple[str, str, str], str]:
+    saved = await load_json_async(TELEGRAPH_URLS_FILE)
+    return await get_cached_index(LINKS_JSON, "telegraph_urls", functools.partial(_build_telegraph_urls, saved))
+
+
+# Сериализует запись telegraph_urls.json
+_TELEGRAPH_URLS_LOCK = asyncio.Lock()
+
+
+async def save_telegraph_urls() -> bool:
+    """Сохраняет известные URL страниц вместе с отпечатками ссылок, по которым они созданы."""
+    async with _TELEGRAPH_URLS_LOCK:
+        links_data = await load_json_async(LINKS_JSON) or {}
+        saved = {}
+        for (collection_key, comic_key, chapter_key), url in (await get_telegraph_urls()).items():
+            links_list = links_data.get(collection_key, {}).get(comic_key, {}).get(chapter_key)
+            if links_list:
+                saved.setdefault(collection_key, {}).setdefault(comic_key, {})[chapter_key] = [url, _links_digest(links_list)]
+        return await save_json_async(TELEGRAPH_URLS_FILE, saved)
+
+
+# Отложенное сохранение после создания страниц из хэндлера: несколько новых URL пишутся одним файлом
+TELEGRAPH_URLS_SAVE_DELAY = 5.0
+_telegraph_save_task: Optional[asyncio.Task] = None
+
+
+async def _save_telegraph_urls_later(delay: float) -> None:
+    global _telegraph_save_task
+    await asyncio.sleep(delay)
+    # URL, добавленные во время записи, запланируют новое сохранение
+    _telegraph_save_task = None
+    await save_telegraph_urls()
+
+
+def schedule_telegraph_urls_save(delay: float = TELEGRAPH_URLS_SAVE_DELAY) -> None:
+    """Планирует сохранение telegraph_urls.json в фоне, не задерживая ответ пользователю."""
+    global _telegraph_save_task
+    if _telegraph_save_task is None:
+        _telegraph_save_task = asyncio.create_task(_save_telegraph_urls_later(delay), name="save_telegraph_urls")
+        _telegraph_save_task.add_done_callback(_log_task_failure)
+
+
+async def flush_telegraph_urls() -> None:
+    """Сразу записывает отложенное сохранение (при остановке бота)."""
+    global _telegraph_save_task
+    if _telegraph_save_task is not None:
+        _telegraph_save_task.cancel()
+        _telegraph_save_task = None
+        await save_telegraph_urls()
+
+
+async def prepopulate_telegraph(telegraph: TelegraphClient, save_every: int = 50) -> int:
+    """
+    Создаёт страницы Telegra.ph для всех глав, у которых их ещё нет, чтобы при чтении
+    оставался только поиск URL в словаре. Страницы создаются по одной, прогресс
+    периодически сохраняется. Возвращает число созданных страниц.
+    """
+    titles, links_data, page_urls = await asyncio.gather(
+        get_chapter_titles(), load_json_async(LINKS_JSON), get_telegraph_urls()
+    )
+    created = saved = 0
+    try:
+        for chapter_id, (comic_title, chapter_title) in titles.items():
+            collection_key, comic_key, chapter_key = chapter_id
+            links_list = (links_data or {}).get(collection_key, {}).get(comic_key, {}).get(chapter_key)
+            if not links_list or chapter_id in page_urls:
+                continue
+
+            content = await get_page_content(collection_key, comic_key, chapter_key, links_list)
+            for attempt in range(2):
+                try:
+                    response = await telegraph.create_page(
+                        title=f"{comic_title} - {chapter_title}",
+                        author_name=COMICS_AUTHOR_NAME,
+                        content=content,
+                    )
+                except (TelegraphError, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    # FLOOD_WAIT_<секунды>: ждём и пробуем ещё раз
+                    wait = str(e).removeprefix("FLOOD_WAIT_")
+                    if attempt == 0 and isinstance(e, TelegraphError) and wait.isdigit():
+                        await asyncio.sleep(int(wait))
+                        continue
+                    # Сетевой сбой или битый ответ не останавливает обход — переходим к следующей главе
+                    log.warning("⚠️ Не удалось создать страницу для %s - %s: %r", comic_title, chapter_title, e)
+                else:
+                    if response.get("url"):
+                        page_urls[chapter_id] = response["url"]
+                        created += 1
+                        if created % save_every == 0:
+                            await save_telegraph_urls()
+                            saved = created
+                break
+    finally:
+        # Сохраняем и то, что создано после последней контрольной точки (в том числе при остановке бота)
+        if created > saved:
+            await save_telegraph_urls()
+    return created
+
+
+# Получает контент страницы главы, собирая его только при первом обращении
+async def get_page_content(collection_key: str, comic_key: str, chapter_key: str, links_list: list[str]) -> str:
+    contents = await get_cached_index(LINKS_JSON, "page_content", _new_chapter_cache)
+    chapter_id = (collection_key, comic_key, chapter_key)
+    content = contents.get(chapter_id)
+    if content is None:
+        content = contents[chapter_id] = create_page_content(links_list)
     return content
 
 
+# Сериализует изменения списка подписчиков (чтение-изменение-запись users.json)
+_USERS_LOCK = asyncio.Lock()
+
+
+def _build_subscriber_set(users: Optional[list]) -> frozenset[int]:
+    """На диске подписчики хранятся списком (в JSON нет множеств), в памяти — множеством."""
+    return frozenset(users) if isinstance(users, list) else frozenset()
+
+
+# Получает множество подписчиков для проверки за O(1)
+async def get_subscribed_users() -> frozenset[int]:
+    return await get_cached_index(USERS_FILE, "subscriber_set", _build_subscriber_set)
+
+
+# Добавление пользователя в список уведомлений (если его там ещё нет)
+async def add_notification_user(user_id: int) -> None:
+    async with _USERS_LOCK:
+        users = await get_subscribed_users()
+        if user_id not in users:
+            await save_json_async(USERS_FILE, sorted(users | {user_id}))
+
+
 # Добавление/удаление пользователя из списка уведомлений
 async def toggle_notification_user(user_id: int) -> bool:
-    users = await load_json_async(USERS_FILE) or []
-    if not isinstance(users, list):
-        users = []
-    if user_id in users:
-        users.remove(user_id)
-        await save_json_async(USERS_FILE, users)
-        return False  # Удален
-    else:
-        users.append(user_id)
-        await save_json_async(USERS_FILE, users)
-        return True  # Добавлен
+    async with _USERS_LOCK:
+        users = await get_subscribed_users()
+        if user_id in users:
+            await save_json_async(USERS_FILE, sorted(users - {user_id}))
+            return False  # Удален
+        else:
+            await save_json_async(USERS_FILE, sorted(users | {user_id}))
+            return True  # Добавлен
 
 
 # --- Генерация клавиатур (Улучшенный UI) ---
 
 
-async def get_main_menu_markup(user_id: int) -> types.InlineKeyboardMarkup:
+def is_same_markup(message: Optional[types.MaybeInaccessibleMessage], markup: types.InlineKeyboardMarkup) -> bool:
+    """
+    Проверяет, совпадает ли клавиатура с уже прикреплённой к сообщению.
+    Текущая клавиатура приходит вместе с callback, поэтому сравнение не требует запросов к API.
+    """
+    current = getattr(message, "reply_markup", None)
+    if current is None:
+        return False
+    return current.model_dump_json(exclude_none=True) == markup.model_dump_json(exclude_none=True)
+
+
+def _build_main_menu_markup(is_subscribed: bool) -> types.InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
 
     # Кнопка поиска
     builder.row(
         types.InlineKeyboardButton(
             text="🔍 Поиск комикса", 
-            callback_data=MenuCallback(action="search").pack()
+            callback_data=_PACKED["search"]
         )
     )
 
@@ -233,7 +810,7 @@ async def get_main_menu_markup(user_id: int) -> types.InlineKeyboardMarkup:
     builder.row(
         types.InlineKeyboardButton(
             text="🎲 Случайный комикс", 
-            callback_data=MenuCallback(action="random").pack()
+            callback_data=_PACKED["random"]
         )
     )
     # <--- КОНЕЦ КНОПКИ РАНДОМАЙЗЕРА --->
@@ -242,7 +819,7 @@ async def get_main_menu_markup(user_id: int) -> types.InlineKeyboardMarkup:
     builder.row(
         types.InlineKeyboardButton(
             text="📚 Каталог коллекций", 
-            callback_data=MenuCallback(action="collections").pack()
+            callback_data=_PACKED["collections"]
         )
     )
     
@@ -251,18 +828,17 @@ async def get_main_menu_markup(user_id: int) -> types.InlineKeyboardMarkup:
     builder.row(
         types.InlineKeyboardButton(
             text="❤️ Поддержать проект", 
-            callback_data=MenuCallback(action="donate").pack()
+            callback_data=_PACKED["donate"]
         )
     )
 
     # Кнопка уведомлений
-    is_subscribed = user_id in (await load_json_async(USERS_FILE) or [])
     notify_icon = "🔔" if is_subscribed else "🔕"
     notify_status = "Вкл" if is_subscribed else "Выкл"
     builder.row(
         types.InlineKeyboardButton(
             text=f"{notify_icon} Уведомления: {notify_status}", 
-            callback_data=MenuCallback(action="toggle_notify").pack()
+            callback_data=_PACKED["toggle_notify"]
         )
     )
 
@@ -271,6 +847,51 @@ async def get_main_menu_markup(user_id: int) -> types.InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+# Главное меню зависит только от статуса подписки — оба варианта собираем один раз при загрузке
+_MAIN_MENU_MARKUPS = {is_subscribed: _build_main_menu_markup(is_subscribed) for is_subscribed in (True, False)}
+
+
+# Единственная кнопка «🏠 В главное меню» для веток с ошибками — неизменяемая, собираем один раз
+_BACK_TO_MAIN_MARKUP = InlineKeyboardBuilder().row(
+    types.InlineKeyboardButton(text="🏠 В главное меню", callback_data=_PACKED["back"])
+).as_markup()
+
+
+# Прочие неизменяемые клавиатуры тоже собираем один раз при загрузке
+_DONATE_MARKUP = InlineKeyboardBuilder().row(
+    types.InlineKeyboardButton(text="🏠 В меню", callback_data=_PACKED["back"])
+).as_markup()
+
+_SEARCH_CANCEL_MARKUP = InlineKeyboardBuilder().row(
+    types.InlineKeyboardButton(text="❌ Отмена и назад", callback_data=_PACKED["back"])
+).as_markup()
+
+_SEARCH_RETRY_MARKUP = InlineKeyboardBuilder().row(
+    types.InlineKeyboardButton(text="🔍 Попробовать снова", callback_data=_PACKED["search"]),
+    types.InlineKeyboardButton(text="🏠 В меню", callback_data=_PACKED["back"])
+).as_markup()
+
+_BROADCAST_MARKUP = InlineKeyboardBuilder().row(
+    types.InlineKeyboardButton(text="📚 Перейти в каталог", callback_data=_PACKED["collections"])
+).as_markup()
+
+
+@functools.lru_cache(maxsize=1024)
+def get_back_to_chapters_markup(collection_key: str, comic_id: str, comic_title: str) -> types.InlineKeyboardMarkup:
+    """Кнопка «⬅️ К главам» одинакова для всех глав комикса — собираем её один раз на комикс."""
+    return InlineKeyboardBuilder().row(
+        types.InlineKeyboardButton(
+            text=f"⬅️ К главам: {comic_title}",
+            callback_data=_pack_comic(collection_key, comic_id, "open", 1),
+        )
+    ).as_markup()
+
+
+async def get_main_menu_markup(user_id: int) -> types.InlineKeyboardMarkup:
+    is_subscribed = user_id in await get_subscribed_users()
+    return _MAIN_MENU_MARKUPS[is_subscribed]
+
+
 async def get_collections_markup() -> types.InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     data = await get_all_data()
@@ -290,7 +911,7 @@ async def get_collections_markup() -> types.InlineKeyboardMarkup:
     builder.row(
         types.InlineKeyboardButton(
             text="🏠 В главное меню", # Изменено на более дружелюбную иконку
-            callback_data=MenuCallback(action="back").pack()
+            callback_data=_PACKED["back"]
         )
     )
 
@@ -310,24 +931,24 @@ async def get_comics_markup(collection_key: str, page: int = 1) -> types.InlineK
         )
         return builder.as_markup()
 
-    # Сортируем ключи комиксов по алфавиту для стабильности
-    comic_keys = sorted(comics_data.keys(), key=lambda k: comics_data[k].get("title", k)) # Сортируем по названию, а не ключу
+    # Ключи комиксов уже отсортированы по названию (а не ключу) и закэшированы
+    comic_keys = await get_sorted_comic_keys(collection_key)
+    comic_ids = await get_comic_ids()
 
     # Логика пагинации (10 комиксов на страницу)
     ITEMS_PER_PAGE = 10
-    start_index = (page - 1) * ITEMS_PER_PAGE
+    start_index = max(page - 1, 0) * ITEMS_PER_PAGE  # islice не принимает отрицательные индексы
     end_index = start_index + ITEMS_PER_PAGE
-    comics_on_page = comic_keys[start_index:end_index]
-    total_pages = math.ceil(len(comic_keys) / ITEMS_PER_PAGE)
+    total_pages = (len(comic_keys) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
 
     # Добавляем кнопки комиксов
-    for key in comics_on_page:
+    for key in itertools.islice(comic_keys, start_index, end_index):
         title = comics_data[key].get("title", key)
         # Добавляем эмодзи для лучшего вида
         builder.row(
             types.InlineKeyboardButton(
                 text=f"📜 {title}",
-                callback_data=ComicCallback(collection_key=collection_key, comic_key=key, action="open", page=1).pack(),
+                callback_data=_pack_comic(collection_key, comic_ids.id_of(collection_key, key), "open", 1),
             )
         )
 
@@ -338,7 +959,7 @@ async def get_comics_markup(collection_key: str, page: int = 1) -> types.InlineK
             nav_buttons.append(
                 types.InlineKeyboardButton(
                     text="«", # Более компактный символ
-                    callback_data=ComicCallback(collection_key=collection_key, comic_key="placeholder", action="page", page=page - 1).pack(),
+                    callback_data=_pack_comic(collection_key, "placeholder", "page", page - 1),
                 )
             )
 
@@ -348,7 +969,7 @@ async def get_comics_markup(collection_key: str, page: int = 1) -> types.InlineK
             nav_buttons.append(
                 types.InlineKeyboardButton(
                     text="»", # Более компактный символ
-                    callback_data=ComicCallback(collection_key=collection_key, comic_key="placeholder", action="page", page=page + 1).pack(),
+                    callback_data=_pack_comic(collection_key, "placeholder", "page", page + 1),
                 )
             )
 
@@ -365,56 +986,52 @@ async def get_comics_markup(collection_key: str, page: int = 1) -> types.InlineK
     return builder.as_markup()
 
 
+@functools.lru_cache(maxsize=8192)
+def chapter_button_label(title: str) -> str:
+    """
+    Текст кнопки главы: для названий вида "Глава N" — только N, для компактности.
+    Кэшируется, чтобы не приводить название к нижнему регистру при каждом листании.
+    """
+    if "глава" in title.lower():
+        match = _CHAPTER_NUM_RE.search(title)
+        if match:
+            return match.group(0)
+    return title
+
+
 async def get_chapter_buttons_markup(collection_key: str, comic_key: str, page: int = 1) -> types.InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
 
-    # 1. Получаем заголовок комикса
-    comics_data = await get_comics_data(collection_key)
-    comic_title = comics_data.get(comic_key, {}).get("title", "Комикс")
-
-    # 2. Извлекаем данные о главах
+    # Извлекаем данные о главах
     chapters_data = await get_chapters_data(collection_key, comic_key)
 
     if not chapters_data:
         builder.row(
             types.InlineKeyboardButton(
                 text="⬅️ Назад к комиксам",
-                callback_data=ComicCallback(collection_key=collection_key, comic_key="placeholder", action="back").pack(), # Используем "placeholder"
+                callback_data=_pack_comic(collection_key, "placeholder", "back"), # Используем "placeholder"
             )
         )
         return builder.as_markup()
 
-    # Используем natural_sort_key для правильной сортировки
-    chapter_keys = sorted(chapters_data.keys(), key=natural_sort_key)
+    # Ключи уже отсортированы через natural_sort_key и закэшированы
+    chapter_keys = await get_sorted_chapter_keys(collection_key, comic_key)
+    comic_id = (await get_comic_ids()).id_of(collection_key, comic_key)
 
     # Логика пагинации
     ITEMS_PER_PAGE = 20  # 5 кнопок в ряду * 4 ряда = 20
-    start_index = (page - 1) * ITEMS_PER_PAGE
+    start_index = max(page - 1, 0) * ITEMS_PER_PAGE  # islice не принимает отрицательные индексы
     end_index = start_index + ITEMS_PER_PAGE
-    chapters_on_page = chapter_keys[start_index:end_index]
-    total_chapters = len(chapter_keys)
-    total_pages = math.ceil(total_chapters / ITEMS_PER_PAGE)
-
-    # Добавляем кнопки глав
-    for i, key in enumerate(chapters_on_page):
-        # Номер главы в списке начинается с 1. Используем этот номер для колбэка.
-        chapter_number_for_callback = i + 1 + start_index 
-        
-        # Получаем номер/название из данных для отображения
-        title = chapters_data[key]
-        
-        # Если название главы - это просто "Глава N", то отображаем только N
-        display_text = title
-        if "глава" in title.lower():
-             # Пытаемся отобразить только число, если это возможно, для компактности
-            match = re.search(r'\d+', title)
-            if match:
-                display_text = match.group(0)
+    total_pages = (len(chapter_keys) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
 
+    # Добавляем кнопки глав.
+    # Номер главы в списке начинается с 1. Используем этот номер для колбэка.
+    chapters_on_page = itertools.islice(chapter_keys, start_index, end_index)
+    for chapter_number_for_callback, key in enumerate(chapters_on_page, start=start_index + 1):
         builder.button(
-            text=display_text, # Компактный вид
+            text=chapter_button_label(chapters_data[key]), # Компактный вид
             # Здесь chapter_number_for_callback - это абсолютный порядковый номер главы в отсортированном списке
-            callback_data=ComicCallback(collection_key=collection_key, comic_key=comic_key, action="read", page=chapter_number_for_callback).pack(),
+            callback_data=_pack_comic(collection_key, comic_id, "read", chapter_number_for_callback),
         )
 
     builder.adjust(CHAPTERS_PER_ROW)
@@ -426,7 +1043,7 @@ async def get_chapter_buttons_markup(collection_key: str, comic_key: str, page:
             nav_buttons.append(
                 types.InlineKeyboardButton(
                     text="«", # Более компактный символ
-                    callback_data=ComicCallback(collection_key=collection_key, comic_key=comic_key, action="page", page=page - 1).pack(),
+                    callback_data=_pack_comic(collection_key, comic_id, "page", page - 1),
                 )
             )
 
@@ -436,7 +1053,7 @@ async def get_chapter_buttons_markup(collection_key: str, comic_key: str, page:
             nav_buttons.append(
                 types.InlineKeyboardButton(
                     text="»", # Более компактный символ
-                    callback_data=ComicCallback(collection_key=collection_key, comic_key=comic_key, action="page", page=page + 1).pack(),
+                    callback_data=_pack_comic(collection_key, comic_id, "page", page + 1),
                 )
             )
 
@@ -446,7 +1063,7 @@ async def get_chapter_buttons_markup(collection_key: str, comic_key: str, page:
     builder.row(
         types.InlineKeyboardButton(
             text=f"⬅️ К списку комиксов", # Изменен текст для ясности
-            callback_data=ComicCallback(collection_key=collection_key, comic_key="placeholder", action="back", page=1).pack(), # comic_key="placeholder" для back_to_comics_handler
+            callback_data=_pack_comic(collection_key, "placeholder", "back", 1), # comic_key="placeholder" для back_to_comics_handler
         )
     )
 
@@ -459,11 +1076,7 @@ async def get_chapter_buttons_markup(collection_key: str, comic_key: str, page:
 async def start_handler(message: types.Message, state: FSMContext):
     await state.clear()
 
-    user_id = message.from_user.id
-    users = await load_json_async(USERS_FILE) or []
-    if user_id not in users:
-        users.append(user_id)
-        await save_json_async(USERS_FILE, users)
+    await add_notification_user(message.from_user.id)
 
     text = (
         "👋 **Добро пожаловать в @eeasychanel!**\n\n"
@@ -473,7 +1086,7 @@ async def start_handler(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
 
 
-@dp.callback_query(MenuCallback.filter(F.action == "back"))
+@callback_route(MenuCallback, "back")
 async def back_to_main_menu_handler(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     text = (
@@ -490,7 +1103,7 @@ async def back_to_main_menu_handler(callback: types.CallbackQuery, state: FSMCon
 
 
 # <--- НОВЫЙ ХЭНДЛЕР: РАНДОМАЙЗЕР --->
-@dp.callback_query(MenuCallback.filter(F.action == "random"))
+@callback_route(MenuCallback, "random")
 async def random_comic_handler(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer("🎲 Ищу случайный комикс...", show_alert=False)
@@ -500,9 +1113,7 @@ async def random_comic_handler(callback: types.CallbackQuery, state: FSMContext)
     if not all_comics:
         await callback.message.edit_text(
             "❌ В боте пока нет комиксов для случайного выбора.",
-            reply_markup=InlineKeyboardBuilder().row(
-                types.InlineKeyboardButton(text="🏠 В главное меню", callback_data=MenuCallback(action="back").pack())
-            ).as_markup(),
+            reply_markup=_BACK_TO_MAIN_MARKUP,
             parse_mode=ParseMode.MARKDOWN
         )
         return
@@ -512,8 +1123,8 @@ async def random_comic_handler(callback: types.CallbackQuery, state: FSMContext)
     collection_key, comic_key, comic_title = chosen_comic
     
     # 1. Получаем данные о главах
-    chapters_data = await get_chapters_data(collection_key, comic_key)
-    chapters_count = len(chapters_data)
+    comic = await resolve_comic(collection_key, comic_key)
+    chapters_count = len(comic.chapters)
     chapters_info = f"({chapters_count} глав)" if chapters_count else "(Нет глав)"
 
     # 2. Генерируем клавиатуру глав
@@ -530,7 +1141,7 @@ async def random_comic_handler(callback: types.CallbackQuery, state: FSMContext)
 # <--- КОНЕЦ НОВОГО ХЭНДЛЕРА: РАНДОМАЙЗЕР --->
 
 # Примерно после 305-й строки
-@dp.callback_query(MenuCallback.filter(F.action == "donate"))
+@callback_route(MenuCallback, "donate")
 async def donate_handler(callback: types.CallbackQuery):
     donate_text = (
         "<b>❤️ Поддержка EasyReaderBot</b>\n\n"
@@ -538,20 +1149,17 @@ async def donate_handler(callback: types.CallbackQuery):
         "• <b>Карта:</b> <code>4400 4303 1975 6729</code>\n"
         "• <b>Крипта:</b> <code>TM5W6YDRTx7EQnSXB6bXvxPvq5YhwteXt5</code>"
     )
-    builder = InlineKeyboardBuilder()
-    builder.row(types.InlineKeyboardButton(text="🏠 В меню", callback_data=MenuCallback(action="back").pack()))
-    
-    await callback.message.edit_text(donate_text, reply_markup=builder.as_markup(), parse_mode=ParseMode.HTML)
+    await callback.message.edit_text(donate_text, reply_markup=_DONATE_MARKUP, parse_mode=ParseMode.HTML)
     await callback.answer()
 
-@dp.callback_query(MenuCallback.filter(F.action == "collections"))
+@callback_route(MenuCallback, "collections")
 async def open_collections_handler(callback: types.CallbackQuery):
     markup = await get_collections_markup()
     await callback.message.edit_text("📚 **Каталог коллекций**\n\nНачните просмотр, выбрав одно из издательств:", reply_markup=markup, parse_mode=ParseMode.MARKDOWN) # Улучшен текст
     await callback.answer()
 
 
-@dp.callback_query(MenuCallback.filter(F.action == "toggle_notify"))
+@callback_route(MenuCallback, "toggle_notify")
 async def toggle_notify_handler(callback: types.CallbackQuery):
     is_added = await toggle_notification_user(callback.from_user.id)
 
@@ -571,7 +1179,7 @@ async def toggle_notify_handler(callback: types.CallbackQuery):
     await callback.answer(alert_text, show_alert=True)
 
 
-@dp.callback_query(CollectionCallback.filter(F.action == "open"))
+@callback_route(CollectionCallback, "open")
 async def open_comics_handler(callback: types.CallbackQuery, callback_data: CollectionCallback):
     collection_key = callback_data.collection_key
     data = await get_all_data()
@@ -585,14 +1193,14 @@ async def open_comics_handler(callback: types.CallbackQuery, callback_data: Coll
     await callback.answer()
 
 
-@dp.callback_query(CollectionCallback.filter(F.action == "back"))
+@callback_route(CollectionCallback, "back")
 async def back_to_collections_handler(callback: types.CallbackQuery):
     markup = await get_collections_markup()
     await callback.message.edit_text("📚 **Каталог коллекций**\n\nНачните просмотр, выбрав одно из издательств:", reply_markup=markup, parse_mode=ParseMode.MARKDOWN) # Улучшен текст
     await callback.answer()
 
 
-@dp.callback_query(ComicCallback.filter(F.action == "back"))
+@callback_route(ComicCallback, "back")
 async def back_to_comics_handler(callback: types.CallbackQuery, callback_data: ComicCallback):
     # Пагинация для комиксов всегда начинается с 1
     markup = await get_comics_markup(callback_data.collection_key, page=1)
@@ -607,38 +1215,45 @@ async def back_to_comics_handler(callback: types.CallbackQuery, callback_data: C
     await callback.answer()
 
 
-@dp.callback_query(ComicCallback.filter(F.action == "page"))
+@callback_route(ComicCallback, "page")
 async def paginate_comics_handler(callback: types.CallbackQuery, callback_data: ComicCallback):
     # Этот хэндлер используется как для комиксов, так и для глав.
-    if callback_data.comic_key == "placeholder":
+    if callback_data.comic_id == "placeholder":
         # Пагинация для списка комиксов
         markup = await get_comics_markup(callback_data.collection_key, page=callback_data.page)
-        try:
-            await callback.message.edit_reply_markup(reply_markup=markup)
-        except Exception:
-            # Fallback на случай, если сообщение не меняется
-            await callback.answer("Перехожу на страницу...", show_alert=False) 
     else:
         # Пагинация для списка глав
-        markup = await get_chapter_buttons_markup(callback_data.collection_key, callback_data.comic_key, page=callback_data.page)
-        try:
-            await callback.message.edit_reply_markup(reply_markup=markup)
-        except Exception:
-            # Fallback на случай, если сообщение не меняется
-            await callback.answer("Перехожу на страницу...", show_alert=False)
+        comic_key = await resolve_comic_key(callback_data.collection_key, callback_data.comic_id)
+        if comic_key is None:
+            await callback.answer("❌ Комикс не найден.", show_alert=True)
+            return
+        markup = await get_chapter_buttons_markup(callback_data.collection_key, comic_key, page=callback_data.page)
+
+    # Повторный клик по той же странице: клавиатура не меняется — не делаем лишний запрос к API
+    if is_same_markup(callback.message, markup):
+        await callback.answer()
+        return
+
+    try:
+        await callback.message.edit_reply_markup(reply_markup=markup)
+    except Exception:
+        # Fallback на случай, если сообщение не меняется
+        await callback.answer("Перехожу на страницу...", show_alert=False)
 
     await callback.answer()
 
 
-@dp.callback_query(ComicCallback.filter(F.action == "open"))
+@callback_route(ComicCallback, "open")
 async def open_chapters_handler(callback: types.CallbackQuery, callback_data: ComicCallback):
     collection_key = callback_data.collection_key
-    comic_key = callback_data.comic_key
+    comic_key = await resolve_comic_key(collection_key, callback_data.comic_id)
+    if comic_key is None:
+        await callback.answer("❌ Комикс не найден.", show_alert=True)
+        return
 
-    comics_data = await get_comics_data(collection_key)
-    comic_title = comics_data.get(comic_key, {}).get("title", "Комикс")
-    chapters_data = await get_chapters_data(collection_key, comic_key)
-    chapters_count = len(chapters_data)
+    comic = await resolve_comic(collection_key, comic_key)
+    comic_title = comic.title
+    chapters_count = len(comic.chapters)
 
     markup = await get_chapter_buttons_markup(collection_key, comic_key)
     
@@ -650,31 +1265,23 @@ async def open_chapters_handler(callback: types.CallbackQuery, callback_data: Co
     await callback.answer()
 
 
-@dp.callback_query(ComicCallback.filter(F.action == "read"))
+@callback_route(ComicCallback, "read")
 async def read_chapter_handler(callback: types.CallbackQuery, callback_data: ComicCallback):
     collection_key = callback_data.collection_key
-    comic_key = callback_data.comic_key
-    
-    # ПЕРЕРАБОТАННАЯ ЛОГИКА ПОЛУЧЕНИЯ КЛЮЧА ГЛАВЫ
-    chapters_data = await get_chapters_data(collection_key, comic_key)
-    chapter_keys = sorted(chapters_data.keys(), key=natural_sort_key)
-    
-    # Номер главы в списке начинается с 1. Индекс в списке - (page - 1).
-    chapter_index = callback_data.page - 1
+    comic_key = await resolve_comic_key(collection_key, callback_data.comic_id)
+    if comic_key is None:
+        await callback.answer("❌ Комикс не найден.", show_alert=True)
+        return
     
-    if chapter_index < 0 or chapter_index >= len(chapter_keys):
+    # Номер главы в списке начинается с 1 и передаётся в поле page.
+    # Заголовки и ссылки на изображения получаем за одно обращение к каталогу.
+    chapter = await resolve_chapter(collection_key, comic_key, callback_data.page)
+
+    if chapter is None:
         await callback.answer("❌ Неверный номер главы.", show_alert=True)
         return
-        
-    chapter_key = chapter_keys[chapter_index] 
-    
-    # 1. Получаем заголовок
-    comics_data = await get_comics_data(collection_key)
-    comic_title = comics_data.get(comic_key, {}).get("title", "Комикс")
-    chapter_title = chapters_data.get(chapter_key, f"Глава {callback_data.page}")
 
-    # 2. Получаем данные о ссылках на изображения
-    links_list = await get_links_list(collection_key, comic_key, chapter_key)
+    comic_title, chapter_key, chapter_title, links_list = chapter
 
     if not links_list:
         await callback.answer("❌ Ссылки для этой главы не найдены.", show_alert=True)
@@ -685,102 +1292,86 @@ async def read_chapter_handler(callback: types.CallbackQuery, callback_data: Com
 
     # 3. Создаем страницу Telegra.ph (если включен и доступен)
     if telegraph:
-        # Улучшено: показываем пользователю, что ждём
-        await callback.answer("⏳ Создаю страницу Telegra.ph. Это может занять несколько секунд...", show_alert=False) 
+        # Страница для этой главы уже создавалась — отдаём её без запроса к Telegra.ph
+        chapter_id = (collection_key, comic_key, chapter_key)
+        page_urls = await get_telegraph_urls()
+        page_url = page_urls.get(chapter_id)
+
+        if page_url is None:
+            # Улучшено: показываем пользователю, что ждём
+            await callback.answer("⏳ Создаю страницу Telegra.ph. Это может занять несколько секунд...", show_alert=False) 
+        else:
+            await callback.answer()
         
         # --- Клавиатура для Telegra.ph (используется как fallback) ---
-        markup_back_to_chapters = InlineKeyboardBuilder()
-        markup_back_to_chapters.row(
-            types.InlineKeyboardButton(
-                text=f"⬅️ К главам: {comic_title}",
-                callback_data=ComicCallback(collection_key=collection_key, comic_key=comic_key, action="open", page=1).pack(),
-            )
-        )
-        
+        markup_back_to_chapters = get_back_to_chapters_markup(collection_key, callback_data.comic_id, comic_title)
+
         try:
-            # Используем to_thread для синхронного метода create_page
-            html_content = create_html_content(links_list)
-            
-            # Запускаем синхронный метод в отдельном потоке
-            response = await to_thread(
-                telegraph.create_page,
-                title=f"{comic_title} - {chapter_title}",
-                author_name=COMICS_AUTHOR_NAME,
-                html_content=html_content,
-            )
-            
-            page_url = response.get("url")
+            if page_url is None:
+                response = await telegraph.create_page(
+                    title=f"{comic_title} - {chapter_title}",
+                    author_name=COMICS_AUTHOR_NAME,
+                    content=await get_page_content(collection_key, comic_key, chapter_key, links_list),
+                )
+                page_url = response.get("url")
+                if page_url:
+                    page_urls[chapter_id] = page_url
+                    schedule_telegraph_urls_save()
+
             if page_url:
                 # УСПЕХ: Отправляем ссылку на Telegra.ph
                 
-                # Добавляем кнопку "Перейти к главе"
-                markup_link = InlineKeyboardBuilder()
-                markup_link.row(
-                    types.InlineKeyboardButton(
-                        text=f"↗️ Читать главу: {chapter_title}",
-                        url=page_url
-                    )
-                )
-                markup_link.row(
-                    types.InlineKeyboardButton(
-                        text=f"⬅️ К главам: {comic_title}",
-                        callback_data=ComicCallback(collection_key=collection_key, comic_key=comic_key, action="open", page=1).pack(),
-                    )
-                )
+                # Добавляем кнопку "Перейти к главе" над готовой кнопкой возврата к главам
+                markup_link = types.InlineKeyboardMarkup(inline_keyboard=[
+                    [types.InlineKeyboardButton(text=f"↗️ Читать главу: {chapter_title}", url=page_url)],
+                    *markup_back_to_chapters.inline_keyboard,
+                ])
                 
                 await callback.message.edit_text(
                     f"✅ Глава **{chapter_title}** готова!\n\nНажмите кнопку ниже, чтобы начать чтение.",
                     parse_mode=ParseMode.MARKDOWN, # Возвращаем MARKDOWN для выделения жирным
-                    reply_markup=markup_link.as_markup(),
+                    reply_markup=markup_link,
                 )
                 return
         except Exception as e:
-            if tg_exceptions and isinstance(e, tg_exceptions.TelegraphException):
+            if isinstance(e, TelegraphError):
                 error_message = f"API Telegra.ph: {e}"
             else:
                 error_message = f"Неизвестная ошибка: {e}"
-            print(f"⚠️ Ошибка создания страницы Telegra.ph для {chapter_title}: {error_message}")
+            log.warning("⚠️ Ошибка создания страницы Telegra.ph для %s: %s", chapter_title, error_message)
 
             # ОШИБКА TELEGRAPH: Уведомляем об ошибке и возвращаем к главам
             await callback.message.edit_text(
                 f"❌ **Не удалось создать страницу Telegra.ph** для главы **{chapter_title}**.\n\n"
                 f"Пожалуйста, повторите попытку или выберите другую главу.",
                 parse_mode=ParseMode.MARKDOWN,
-                reply_markup=markup_back_to_chapters.as_markup() # Возвращаем кнопку назад к главам
+                reply_markup=markup_back_to_chapters # Возвращаем кнопку назад к главам
             )
             return
     else:
         # TELEGRAPH ОТКЛЮЧЕН/НЕДОСТУПЕН
         
         # Клавиатура для возврата к главам
-        markup_back_to_chapters = InlineKeyboardBuilder()
-        markup_back_to_chapters.row(
-            types.InlineKeyboardButton(
-                text=f"⬅️ К главам: {comic_title}",
-                callback_data=ComicCallback(collection_key=collection_key, comic_key=comic_key, action="open", page=1).pack(),
-            )
-        )
-        
+        markup_back_to_chapters = get_back_to_chapters_markup(collection_key, callback_data.comic_id, comic_title)
+
         await callback.message.edit_text(
             f"❌ **{comic_title} - {chapter_title}**\n\n_Telegra.ph отключен или не был инициализирован_.\n\n"
             "Чтение глав недоступно.",
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=markup_back_to_chapters.as_markup()
+            reply_markup=markup_back_to_chapters
         )
         await callback.answer("Чтение недоступно: Telegra.ph отключен.", show_alert=True)
         return
 
 
-@dp.callback_query(MenuCallback.filter(F.action == "search"))
+@callback_route(MenuCallback, "search")
 async def start_search_handler(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(SearchState.waiting_for_query)
 
     await callback.message.edit_text(
         "🔍 **Поиск комикса**\n\nВведите полное название или часть названия комикса. Я найду все совпадения:",
         parse_mode=ParseMode.MARKDOWN,
-        reply_markup=InlineKeyboardBuilder()
-        .row(types.InlineKeyboardButton(text="❌ Отмена и назад", callback_data=MenuCallback(action="back").pack()))
-        .as_markup(),
+        reply_markup=_SEARCH_CANCEL_MARKUP,
     )
     await callback.answer()
 
@@ -792,59 +1383,96 @@ async def process_search_query(message: types.Message, state: FSMContext):
     if not query:
         await message.answer(
             "❌ Вы не ввели запрос. Попробуйте снова.",
-            reply_markup=InlineKeyboardBuilder().row(types.InlineKeyboardButton(text="🏠 В меню", callback_data=MenuCallback(action="back").pack())).as_markup(),
+            reply_markup=_BACK_TO_MAIN_MARKUP,
         )
         return
 
-    all_data = await get_all_data()
-    found_comics = []
-
-    if all_data:
-        for collection_key, collection_data in all_data.items():
-            comics_in_collection = collection_data.get("comics", {})
-            for comic_key, comic_data in comics_in_collection.items():
-                title = comic_data.get("title", comic_key)
-                if query in title.lower():
-                    found_comics.append({"title": title, "collection_key": collection_key, "comic_key": comic_key})
+    found_comics = [
+        {"title": title, "collection_key": collection_key, "comic_key": comic_key}
+        for _, collection_key, comic_key, title in await search_comics(query)
+    ]
 
     if found_comics:
+        comic_ids = await get_comic_ids()
         builder = InlineKeyboardBuilder()
         message_text = f"✅ **Найдено {len(found_comics)} совпадений**:\n"
-        found_comics.sort(key=lambda x: x["title"])
 
         for item in found_comics:
             builder.row(types.InlineKeyboardButton(
                 text=f"📜 {item['title']}",
-                callback_data=ComicCallback(collection_key=item["collection_key"], comic_key=item["comic_key"], action="open", page=1).pack()
+                callback_data=_pack_comic(item["collection_key"], comic_ids.id_of(item["collection_key"], item["comic_key"]), "open", 1)
             ))
-        builder.row(types.InlineKeyboardButton(text="🏠 В главное меню", callback_data=MenuCallback(action="back").pack()))
+        builder.row(types.InlineKeyboardButton(text="🏠 В главное меню", callback_data=_PACKED["back"]))
         await message.answer(message_text, reply_markup=builder.as_markup(), parse_mode=ParseMode.MARKDOWN)
     else:
         await message.answer(
             f"❌ По запросу «{message.text}» ничего не найдено.",
-            reply_markup=InlineKeyboardBuilder().row(
-                types.InlineKeyboardButton(text="🔍 Попробовать снова", callback_data=MenuCallback(action="search").pack()),
-                types.InlineKeyboardButton(text="🏠 В меню", callback_data=MenuCallback(action="back").pack())
-            ).as_markup(),
+            reply_markup=_SEARCH_RETRY_MARKUP,
         )
 
 # --- Рассылка ---
+# Telegram пропускает около 30 сообщений в секунду от одного бота
+BROADCAST_RATE_PER_SEC = 30
+BROADCAST_WORKERS = 8
+_broadcast_limiter = AsyncLimiter(BROADCAST_RATE_PER_SEC, 1)
+# Момент (по time.monotonic), до которого Telegram запретил отправку: общий для всех воркеров
+_broadcast_paused_until = 0.0
+
+
+async def _wait_broadcast_pause() -> None:
+    """Ждёт окончания flood-wait, объявленного любым из воркеров."""
+    while (delay := _broadcast_paused_until - time.monotonic()) > 0:
+        await asyncio.sleep(delay)
+
+
+async def _broadcast_worker(bot_obj: Bot, queue: asyncio.Queue, text: str, markup: types.InlineKeyboardMarkup, sent: list[int]):
+    """Забирает получателей из очереди; частоту отправки ограничивает общий лимитер."""
+    global _broadcast_paused_until
+    while True:
+        user_id = await queue.get()
+        try:
+            # Telegram просит подождать — паузу соблюдают все воркеры, отправка повторяется один раз
+            for attempt in range(2):
+                await _wait_broadcast_pause()
+                try:
+                    async with _broadcast_limiter:
+                        await bot_obj.send_message(user_id, text, reply_markup=markup)
+                except TelegramRetryAfter as e:
+                    if attempt:
+                        raise
+                    _broadcast_paused_until = max(_broadcast_paused_until, time.monotonic() + e.retry_after)
+                else:
+                    break
+            sent.append(user_id)
+        except Exception as e:
+            log.warning("Ошибка отправки %s: %s", user_id, e)
+        finally:
+            queue.task_done()
+
+
 async def broadcast_new_comic(bot_obj: Bot, comic_title: str):
     users = await load_json_async(USERS_FILE) or []
     if not users: return 0
-    count = 0
     text = f"🎉 <b>Новинка в библиотеке!</b>\n\nДобавлен комикс: <b>{comic_title}</b>"
-    builder = InlineKeyboardBuilder()
-    builder.row(types.InlineKeyboardButton(text="📚 Перейти в каталог", callback_data=MenuCallback(action="collections").pack()))
 
+    # Очередь получателей и фиксированное число отправителей: параллельность задаётся
+    # числом воркеров, а частота — лимитером, и они не зависят друг от друга
+    queue: asyncio.Queue = asyncio.Queue()
     for user_id in users:
-        try:
-            await bot_obj.send_message(user_id, text, reply_markup=builder.as_markup())
-            count += 1
-            await asyncio.sleep(0.05) 
-        except Exception as e:
-            print(f"Ошибка отправки {user_id}: {e}")
-    return count
+        queue.put_nowait(user_id)
+
+    sent: list[int] = []
+    workers = [
+        asyncio.create_task(_broadcast_worker(bot_obj, queue, text, _BROADCAST_MARKUP, sent))
+        for _ in range(min(BROADCAST_WORKERS, len(users)))
+    ]
+    try:
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return len(sent)
 
 @dp.message(Command("notify"))
 async def admin_notify_handler(message: types.Message):
@@ -858,27 +1486,148 @@ async def admin_notify_handler(message: types.Message):
     count = await broadcast_new_comic(bot, args[1])
     await status_msg.edit_text(f"✅ Готово! Получили: {count} чел.")
 
+_STALE_BUTTON_TEXT = "⚠️ Эта кнопка устарела. Нажмите /start, чтобы открыть меню заново."
+
+
+async def _unpack_callback(callback_cls: type[CallbackData], data: str) -> CallbackData:
+    """Распаковывает callback_data; кнопки старого формата "comic:" переводит на короткие идентификаторы."""
+    if callback_cls is ComicCallback and data.startswith(LegacyComicCallback.__prefix__ + LegacyComicCallback.__separator__):
+        legacy = LegacyComicCallback.unpack(data)
+        if legacy.comic_key == "placeholder":
+            comic_id = legacy.comic_key
+        else:
+            # Удалённый комикс получает пустой идентификатор, и хэндлер ответит «Комикс не найден»
+            comic_id = (await get_comic_ids()).by_key.get((legacy.collection_key, legacy.comic_key), "")
+        return ComicCallback(collection_key=legacy.collection_key, comic_id=comic_id, action=legacy.action, page=legacy.page)
+    return callback_cls.unpack(data)
+
+
+@dp.callback_query()
+async def dispatch_callback(callback: types.CallbackQuery, state: FSMContext):
+    if callback.data == "ignore":
+        # Счётчик «Страница N/M» — кнопка без действия, просто снимаем «часики»
+        await callback.answer()
+        return
+
+    prefix = (callback.data or "").partition(":")[0]
+    if prefix == LegacyComicCallback.__prefix__:
+        prefix = ComicCallback.__prefix__
+    route = _CALLBACK_ROUTES.get(prefix)
+    if route is None:
+        # Кнопка из старой версии бота или чужие данные
+        await callback.answer(_STALE_BUTTON_TEXT, show_alert=True)
+        return
+
+    callback_cls, actions = route
+    try:
+        callback_data = await _unpack_callback(callback_cls, callback.data)
+    except (TypeError, ValueError):
+        await callback.answer(_STALE_BUTTON_TEXT, show_alert=True)
+        return
+
+    target = actions.get(callback_data.action)
+    if target is None:
+        await callback.answer(_STALE_BUTTON_TEXT, show_alert=True)
+        return
+
+    handler, wants_data, wants_state = target
+    kwargs = {}
+    if wants_data:
+        kwargs["callback_data"] = callback_data
+    if wants_state:
+        kwargs["state"] = state
+    await handler(callback, **kwargs)
+
 # --- Главная функция запуска ---
+async def run_webhook() -> None:
+    """
+    Принимает обновления через вебхук: нет задержки long polling, а каждое обновление
+    обрабатывается в фоне, и Telegram сразу получает ответ на запрос.
+    """
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, handle_in_background=True, secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT).start()
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True,
+        )
+        log.info("🌐 Вебхук слушает %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def _log_task_failure(task: asyncio.Task) -> None:
+    """Фоновые задачи никто не ждёт — их ошибки пишем в лог сразу, а не при остановке бота."""
+    if not task.cancelled() and task.exception() is not None:
+        log.error("❌ Фоновая задача %s завершилась с ошибкой", task.get_name(), exc_info=task.exception())
+
+
 async def main():
-    telegraph_to_save: Optional[Any] = None
+    telegraph_to_save: Optional[TelegraphClient] = None
+    # Общая сессия для Telegra.ph: keep-alive соединения и кэш DNS на всё время работы
+    telegraph_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=50, ttl_dns_cache=300))
 
-    if TELEGRAPH_ENABLED and TELEGRAPH_AVAILABLE:
+    if TELEGRAPH_ENABLED:
         try:
-            telegraph_instance = Telegraph()
-            await to_thread(telegraph_instance.create_account, short_name=COMICS_AUTHOR_NAME)
+            telegraph_instance = TelegraphClient(telegraph_session)
+            await telegraph_instance.create_account(short_name=COMICS_AUTHOR_NAME)
             telegraph_to_save = telegraph_instance
-            print("✅ Telegraph готов.")
+            log.info("✅ Telegraph готов.")
         except Exception as e:
-            print(f"⚠️ Ошибка Telegraph: {e}")
+            log.warning("⚠️ Ошибка Telegraph: %s", e)
             telegraph_to_save = None
     
     dp.workflow_data["telegraph"] = telegraph_to_save
 
-    print("🚀 Бот запущен! Ошибок нет.")
-    await dp.start_polling(bot, skip_updates=True)
+    # Каталог читается и индексируется в фоне: бот начинает принимать обновления сразу,
+    # а запросы, пришедшие до конца загрузки, дождутся того же чтения файла
+    warm_up_task = asyncio.create_task(warm_up_caches(), name="warm_up_caches")
+    warm_up_task.add_done_callback(_log_task_failure)
+    prepopulate_task = None
+    if telegraph_to_save and TELEGRAPH_PREPOPULATE:
+        prepopulate_task = asyncio.create_task(prepopulate_telegraph(telegraph_to_save), name="prepopulate_telegraph")
+        prepopulate_task.add_done_callback(_log_task_failure)
+
+    log.info("🚀 Бот запущен! Ошибок нет.")
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # Вебхук, оставшийся от запуска с WEBHOOK_URL, блокирует getUpdates — снимаем его.
+            # Заодно отбрасываем накопившиеся обновления (skip_updates в aiogram 3 не работает)
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        warm_up_task.cancel()
+        if prepopulate_task:
+            prepopulate_task.cancel()
+        await flush_telegraph_urls()
+        await telegraph_session.close()
 
 if __name__ == "__main__":
+    # uvloop — более быстрый цикл событий на libuv; без него работаем на стандартном
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    log_listener = setup_logging()
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
-        print("🤖 Бот остановлен.")
\ No newline at end of file
+        log.info("🤖 Бот остановлен.")
+    finally:
+        log_listener.stop()
\ No newline at end of file
@@ -3,6 +3,14 @@
 import json
 from pathlib import Path
 
+# --- Быстрый JSON (orjson), с откатом на стандартный json ---
+ORJSON_AVAILABLE = False
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except Exception:
+    ORJSON_AVAILABLE = False
+
 DATA_JSON = "data.json"
 LINKS_JSON = "links.json"
 BACKUP_LINKS_JSON = "links_backup.json"
@@ -10,8 +18,8 @@ BACKUP_LINKS_JSON = "links_backup.json"
 def load_json(path):
     """Загружает данные из JSON файла."""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        content = Path(path).read_bytes()
+        return orjson.loads(content) if ORJSON_AVAILABLE else json.loads(content)
     except FileNotFoundError:
         print(f"❌ Ошибка: Файл {path} не найден.")
         return None
@@ -22,8 +30,11 @@ def load_json(path):
 def save_json(path, data):
     """Сохраняет данные в JSON файл."""
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        if ORJSON_AVAILABLE:
+            content = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        else:
+            content = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+        Path(path).write_bytes(content)
         print(f"✅ Успешно сохранено в {path}")
     except Exception as e:
         print(f"❌ Ошибка при записи в {path}: {e}")
@@ -46,7 +57,7 @@ def restructure_links():
 
 
     new_links = {}
-    total_comics_moved = 0
+    matched: set[str] = set()
     
     # 1. Проходим по коллекциям в data.json (dc, marvel, other)
     for collection_key, collection_data in data.items():
@@ -55,20 +66,23 @@ def restructure_links():
             continue
 
         comics_in_collection = collection_data.get('comics', {})
-        new_links[collection_key] = {} # Создаем новый словарь для коллекции
-        
-        # 2. Проходим по комиксам в этой коллекции
-        for comic_key in comics_in_collection.keys():
-            # 3. Ищем этот комикс в старом links.json
-            if comic_key in old_links:
-                # 4. Переносим данные (все главы и ссылки) в новую структуру
-                new_links[collection_key][comic_key] = old_links.pop(comic_key)
-                total_comics_moved += 1
+
+        # 2-4. Переносим главы и ссылки комиксов этой коллекции из старого links.json,
+        # не изменяя его (без pop) — одним проходом
+        new_links[collection_key] = {
+            comic_key: old_links[comic_key]
+            for comic_key in comics_in_collection
+            if comic_key in old_links
+        }
+        matched.update(new_links[collection_key])
+
+    total_comics_moved = len(matched)
 
     # Проверяем, остались ли какие-то комиксы, которые не удалось перенести
-    if old_links:
-        print(f"⚠️ ВНИМАНИЕ: {len(old_links)} комиксов не удалось сопоставить в data.json. Они остались неперемещенными.")
-        print(f"Неперемещенные ключи: {list(old_links.keys())[:5]}...")
+    unmatched = old_links.keys() - matched
+    if unmatched:
+        print(f"⚠️ ВНИМАНИЕ: {len(unmatched)} комиксов не удалось сопоставить в data.json. Они остались неперемещенными.")
+        print(f"Неперемещенные ключи: {list(unmatched)[:5]}...")
 
     # 5. Сохраняем новый links.json
     save_json(LINKS_JSON, new_links)